@@ -96,12 +96,23 @@ if __name__ == "__main__":
     if model_type == "vae":
         model = VAE(config, annotation_path=ann_path)
         # model = VAE(config, n_batches)
-        ddp = DDPStrategy(find_unused_parameters=True, process_group_backend="nccl")
+        # manual optimization with toggled optimizers leaves unused parameters
+        ddp = DDPStrategy(
+            find_unused_parameters=True,
+            gradient_as_bucket_view=True,
+            process_group_backend="nccl",
+        )
     elif model_type == "sqvae":
         if unsupervised_training:
             ann_path = None
         model = SQVAE(config, annotations)
-        ddp = DDPStrategy(find_unused_parameters=False, process_group_backend="nccl")
+        # the sqvae forward is shape-static, so the DDP graph can be frozen
+        ddp = DDPStrategy(
+            find_unused_parameters=False,
+            static_graph=True,
+            gradient_as_bucket_view=True,
+            process_group_backend="nccl",
+        )
     accumulate_grad_batches = config.accumulate_grad_batches
 
     logger = TensorBoardLogger("logs/individual", name=model_type)
@@ -109,6 +120,7 @@ if __name__ == "__main__":
         accelerator="cuda",
         strategy=ddp,
         devices=gpu_ids,
+        precision="bf16-mixed",
         logger=logger,
         callbacks=[model_checkpoint],
         max_epochs=config.epochs,
@@ -161,6 +161,8 @@ def individual_train_dataloader(
             shuffle=True,
             num_workers=config.num_workers,
             pin_memory=True,
+            persistent_workers=True,
+            prefetch_factor=4,
         )
     else:
         dataset, n_batches = load_dataset_iterable(
@@ -174,6 +176,7 @@ def individual_train_dataloader(
             num_workers=config.num_workers,
             pin_memory=True,
             persistent_workers=True,
+            prefetch_factor=4,
         )
         n_batches = int(n_batches / len(gpu_ids) / config.batch_size)
         if n_batches % config.accumulate_grad_batches != 0:
@@ -198,6 +201,8 @@ def individual_pred_dataloader(
             shuffle=False,
             num_workers=config.num_workers,
             pin_memory=True,
+            persistent_workers=True,
+            prefetch_factor=4,
         )
     else:
         dataset, n_batches = load_dataset_iterable(
@@ -211,6 +216,7 @@ def individual_pred_dataloader(
             num_workers=config.num_workers,
             pin_memory=True,
             persistent_workers=True,
+            prefetch_factor=4,
         )
         n_batches = ceil(n_batches / len(gpu_ids) / config.batch_size)
         dataloader.repeat(1, n_batches).with_length(n_batches)
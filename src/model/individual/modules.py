@@ -4,9 +4,14 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from rotary_embedding_torch import RotaryEmbedding
+from torch.utils.checkpoint import checkpoint
 
-from src.model.layers import MLP, TransformerDecoderBlock, TransformerEncoderBlock
+from src.model.layers import (
+    MLP,
+    CachedRotaryEmbedding,
+    TransformerDecoderBlock,
+    TransformerEncoderBlock,
+)
 
 
 def get_n_pts(config: SimpleNamespace):
@@ -51,7 +56,7 @@ class ClassificationHead(nn.Module):
         super().__init__()
         ndim = config.latent_ndim
         self.cls_token = nn.Parameter(torch.randn(1, 1, ndim))
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         self.encoders = nn.ModuleList(
             [
                 TransformerEncoderBlock(
@@ -66,19 +71,23 @@ class ClassificationHead(nn.Module):
     def forward(self, z, is_train):
         # x (b, n_pts, latent_ndim)
         b = z.size(0)
-        cls_token = self.cls_token.repeat(b, 1, 1)
+        cls_token = self.cls_token.expand(b, -1, -1)
         z = torch.cat([cls_token, z], dim=1)
         z = self.pe.rotate_queries_or_keys(z, seq_dim=1)
         if is_train:
             for layer in self.encoders:
-                z, attn_w = layer(z)
+                if self.training:
+                    # recompute activations in backward to save memory
+                    z, attn_w = checkpoint(layer, z, use_reentrant=False)
+                else:
+                    z, attn_w = layer(z)
             attn_w_tensor = None
         else:
             attn_w_lst = []
             for layer in self.encoders:
                 z, attn_w = layer(z, need_weights=True)
-                attn_w_lst.append(attn_w.unsqueeze(1))
-            attn_w_tensor = torch.cat(attn_w_lst, dim=1)
+                attn_w_lst.append(attn_w)
+            attn_w_tensor = torch.stack(attn_w_lst, dim=1)
 
         logits = self.mlp(z[:, 0, :])  # (b, n_clusters)
 
@@ -122,7 +131,7 @@ class Encoder(nn.Module):
         #     [Embedding(config.latent_ndim) for _ in range(self.n_pts * 2)]
         # )
         self.emb = Embedding(config.seq_len, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         self.encoders = nn.ModuleList(
             [
                 TransformerEncoderBlock(
@@ -153,14 +162,18 @@ class Encoder(nn.Module):
 
         if is_train:
             for layer in self.encoders:
-                z, attn_w = layer(z)
+                if self.training:
+                    # recompute activations in backward to save memory
+                    z, attn_w = checkpoint(layer, z, use_reentrant=False)
+                else:
+                    z, attn_w = layer(z)
             attn_w_tensor = None
         else:
             attn_w_lst = []
             for layer in self.encoders:
                 z, attn_w = layer(z, need_weights=True)
-                attn_w_lst.append(attn_w.unsqueeze(1))
-            attn_w_tensor = torch.cat(attn_w_lst, dim=1)
+                attn_w_lst.append(attn_w)
+            attn_w_tensor = torch.stack(attn_w_lst, dim=1)
         # z (b, n_pts * 2, latent_ndim)
 
         return z, attn_w_tensor
@@ -170,11 +183,8 @@ class GaussianVectorQuantizer(nn.Module):
     def __init__(self, config: SimpleNamespace):
         super().__init__()
         self.book_size = config.book_size
-        self.books = nn.ParameterList(
-            [
-                nn.Parameter(torch.randn(self.book_size, config.latent_ndim))
-                for _ in range(config.n_clusters)
-            ]
+        self.books = nn.Parameter(
+            torch.randn(config.n_clusters, self.book_size, config.latent_ndim)
         )
 
         self.temperature = None
@@ -185,19 +195,26 @@ class GaussianVectorQuantizer(nn.Module):
             torch.tensor(log_param_q_cls, dtype=torch.float32)
         )
 
-    def calc_distance(self, z, book):
+    def calc_distance_batched(self, ze, books):
+        # ze (b, n_pts, latent_ndim)
+        # books (n_clusters, book_size, latent_ndim)
+        if ze.is_cuda:
+            # run the dominant cross-term GEMM on bf16 tensor cores; the
+            # squared norms stay in fp32 so the accumulation is stable
+            with torch.autocast("cuda", dtype=torch.bfloat16):
+                cross = torch.einsum("bnd,kmd->bknm", ze, books)
+            cross = cross.float()
+        else:
+            cross = torch.einsum("bnd,kmd->bknm", ze, books)
         distances = (
-            torch.sum(z**2, dim=1, keepdim=True)
-            + torch.sum(book**2, dim=1)
-            - 2 * torch.matmul(z, book.t())
+            torch.sum(ze.float() ** 2, dim=-1, keepdim=True).unsqueeze(1)
+            + torch.sum(books.float() ** 2, dim=-1).unsqueeze(1).unsqueeze(0)
+            - 2 * cross
         )
-        return distances
+        return distances  # (b, n_clusters, n_pts, book_size)
 
-    def gumbel_softmax_relaxation(self, logits, eps=1e-10):
-        U = torch.rand(logits.shape, device=logits.device)
-        g = -torch.log(-torch.log(U + eps) + eps)
-        y = logits + g
-        return F.softmax(y / self.temperature, dim=-1)
+    def gumbel_softmax_relaxation(self, logits):
+        return F.gumbel_softmax(logits, tau=self.temperature, hard=False, dim=-1)
 
     def forward(self, ze, c_logits, is_train):
         # ze (b, n_pts, latent_ndim)
@@ -210,54 +227,34 @@ class GaussianVectorQuantizer(nn.Module):
             param_q = 1 + self.log_param_q_cls.exp()
             precision_q_cls = 0.5 / torch.clamp(param_q, min=1e-10)
 
-            logits = torch.empty((0, n_pts, self.book_size)).to(ze.device)
-            zq = torch.empty((0, n_pts, latent_ndim)).to(ze.device)
-            for i, c_logit in enumerate(c_logits):
-                c_prob = self.gumbel_softmax_relaxation(c_logit * precision_q_cls)
-
-                # compute logits and zq of all books
-                zei = ze[i]
-                zqi = torch.zeros_like(zei)
-                logit = torch.zeros((n_pts, self.book_size)).to(ze.device)
-                books = torch.cat(list(self.books.parameters()), dim=0)
-                books = books.view(-1, self.book_size, latent_ndim)
-                for j, book in enumerate(books):
-                    logitj = -self.calc_distance(zei, book) * precision_q
-                    logit = logit + logitj * c_prob[j]
-                    encoding = self.gumbel_softmax_relaxation(logitj)
-                    zqi = zqi + torch.matmul(encoding, book) * c_prob[j]
-
-                logits = torch.cat(
-                    [logits, logit.view(1, n_pts, self.book_size)], dim=0
-                )
-                books = torch.cat(
-                    [books, book.view(1, self.book_size, latent_ndim)], dim=0
-                )
-                zq = torch.cat([zq, zqi.view(1, n_pts, latent_ndim)], dim=0)
-                # mean_prob = torch.mean(prob.detach(), dim=0)
-        else:
-            logits = torch.empty((0, n_pts, self.book_size)).to(ze.device)
-            books = torch.empty((0, self.book_size, latent_ndim)).to(ze.device)
-            for i, idx in enumerate(c_logits.argmax(dim=-1)):
-                book = self.books[idx]
-                logit = -self.calc_distance(ze[i], book) * precision_q
-
-                logits = torch.cat(
-                    [logits, logit.view(1, n_pts, self.book_size)], dim=0
-                )
-                books = torch.cat(
-                    [books, book.view(1, self.book_size, latent_ndim)], dim=0
-                )
+            c_prob = self.gumbel_softmax_relaxation(c_logits * precision_q_cls)
+            # c_prob (b, n_clusters)
+
+            # compute logits and zq of all books at once
+            logits_all = -self.calc_distance_batched(ze, self.books) * precision_q
+            encodings = self.gumbel_softmax_relaxation(logits_all)
+            # logits_all, encodings (b, n_clusters, n_pts, book_size)
 
-            indices = torch.argmax(logits, dim=2).unsqueeze(2)
-            encodings = torch.zeros(
-                indices.shape[0],
-                indices.shape[1],
-                self.book_size,
-                device=indices.device,
+            logits = torch.einsum("bknm,bk->bnm", logits_all, c_prob)
+            zq = torch.einsum("bknm,kmd,bk->bnd", encodings, self.books, c_prob)
+            # mean_prob = torch.mean(prob.detach(), dim=0)
+        else:
+            idxs = c_logits.argmax(dim=-1)
+            books = self.books[idxs]
+            # books (b, book_size, latent_ndim)
+
+            distances = torch.baddbmm(
+                torch.sum(ze**2, dim=-1, keepdim=True)
+                + torch.sum(books**2, dim=-1).unsqueeze(1),
+                ze,
+                books.transpose(1, 2),
+                alpha=-2,
             )
-            encodings.scatter_(2, indices, 1)
-            zq = torch.matmul(encodings, books)
+            logits = -distances * precision_q
+            # logits (b, n_pts, book_size)
+
+            encodings = F.one_hot(logits.argmax(dim=-1), self.book_size).to(ze.dtype)
+            zq = torch.bmm(encodings, books)
             # mean_prob = torch.mean(encodings, dim=0)
         # zq (b, npts, latent_ndim)
 
@@ -282,18 +279,16 @@ class Decoder(nn.Module):
     def forward(self, kps, bbox, zq):
         b, seq_len = kps.size()[:2]
         kps = kps.view(b, seq_len, -1)
-        recon_kps = torch.empty((b, seq_len, 0)).to(kps.device)
+        recon_kps = []
         for i, decoder in enumerate(self.decoders[: (self.n_pts - 2) * 2]):
-            recon_x = decoder(kps[:, :, i], zq[:, i, :])
-            recon_kps = torch.cat([recon_kps, recon_x], dim=2)
-        recon_kps = recon_kps.view(b, seq_len, (self.n_pts - 2), 2)
+            recon_kps.append(decoder(kps[:, :, i], zq[:, i, :]))
+        recon_kps = torch.cat(recon_kps, dim=2).view(b, seq_len, (self.n_pts - 2), 2)
 
         bbox = bbox.view(b, seq_len, -1)
-        recon_bbox = torch.empty((b, seq_len, 0)).to(bbox.device)
+        recon_bbox = []
         for i, decoder in enumerate(self.decoders[(self.n_pts - 2) * 2 :]):
-            recon_x = decoder(bbox[:, :, i], zq[:, (self.n_pts - 2) * 2 + i, :])
-            recon_bbox = torch.cat([recon_bbox, recon_x], dim=2)
-        recon_bbox = recon_bbox.view(b, seq_len, 2, 2)
+            recon_bbox.append(decoder(bbox[:, :, i], zq[:, (self.n_pts - 2) * 2 + i, :]))
+        recon_bbox = torch.cat(recon_bbox, dim=2).view(b, seq_len, 2, 2)
 
         return recon_kps, recon_bbox
 
@@ -309,7 +304,7 @@ class DecoderModule(nn.Module):
         )
 
         self.emb = MLP(1, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         # self.mlp_z = MLP(config.latent_ndim, config.latent_ndim * config.seq_len)
         self.decoders = nn.ModuleList(
             [
@@ -329,10 +324,7 @@ class DecoderModule(nn.Module):
         #     MLP(config.latent_ndim // 4, 1),
         #     nn.Tanh(),
         # )
-        self.mlp = nn.Sequential(
-            MLP(config.latent_ndim, 1),
-            nn.Tanh(),
-        )
+        self.mlp = MLP(config.latent_ndim, 1)
 
     def forward(self, x, zq, mask=None):
         # x (b, seq_len)
@@ -343,18 +335,22 @@ class DecoderModule(nn.Module):
         x = self.emb(x)  # (b, seq_len, latent_ndim)
 
         # concat start token
-        x = torch.cat([self.x_start.repeat((b, 1, 1)), x], dim=1)
+        x = torch.cat([self.x_start.expand(b, -1, -1), x], dim=1)
         x = x[:, :-1]  # (b, seq_len, latent_ndim)
 
         x = self.pe.rotate_queries_or_keys(x, seq_dim=1)
 
         # zq = self.mlp_z(zq)
         # zq = zq.view(b, seq_len, self.latent_ndim)
-        zq = zq.unsqueeze(1).repeat(1, seq_len, 1)
+        zq = zq.unsqueeze(1).expand(-1, seq_len, -1)
         for layer in self.decoders:
-            x = layer(x, zq, mask)
+            if self.training:
+                # recompute activations in backward to save memory
+                x = checkpoint(layer, x, zq, mask, use_reentrant=False)
+            else:
+                x = layer(x, zq, mask)
         # x (b, seq_len, latent_ndim)
 
-        recon_x = self.mlp(x).view(b, seq_len, 1)
+        recon_x = torch.tanh(self.mlp(x)).view(b, seq_len, 1)
 
         return recon_x
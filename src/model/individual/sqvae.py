@@ -24,6 +24,9 @@ class SQVAE(LightningModule):
         self.temp_min = config.temp_min
         self.latent_ndim = config.latent_ndim
         self.n_clusters = config.n_clusters
+        self.register_buffer(
+            "c_prior", torch.full((1, config.n_clusters), 1 / config.n_clusters)
+        )
 
         self.encoder = None
         self.decoder = None
@@ -35,10 +38,12 @@ class SQVAE(LightningModule):
     def configure_model(self):
         if self.encoder is not None:
             return
-        self.encoder = Encoder(self.config)
-        self.decoder = Decoder(self.config)
+        # shapes are static per config, so compile the core forward graphs
+        compile_kwargs = dict(mode="reduce-overhead", fullgraph=True, dynamic=False)
+        self.encoder = torch.compile(Encoder(self.config), **compile_kwargs)
+        self.decoder = torch.compile(Decoder(self.config), **compile_kwargs)
         self.quantizer = GaussianVectorQuantizer(self.config)
-        self.cls_head = ClassificationHead(self.config)
+        self.cls_head = torch.compile(ClassificationHead(self.config), **compile_kwargs)
 
     def configure_optimizers(self):
         opt = torch.optim.RAdam(self.parameters(), lr=self.config.lr)
@@ -104,8 +109,9 @@ class SQVAE(LightningModule):
         keys, ids, kps, bbox, mask = batch
         keys = np.array(keys).ravel()
         if kps.device != self.device:
-            kps = kps.to(self.device)
-            bbox = bbox.to(self.device)
+            # batches come out of the loader pinned, so the copy can be async
+            kps = kps.to(self.device, non_blocking=True)
+            bbox = bbox.to(self.device, non_blocking=True)
         if kps.ndim == 5:
             ids = ids[0]
             kps = kps[0]
@@ -149,7 +155,7 @@ class SQVAE(LightningModule):
         )
 
         # clustering loss
-        c_prior = torch.full_like(c_prob, 1 / self.n_clusters)
+        c_prior = self.c_prior.expand_as(c_prob)
         c_prob = torch.clamp(c_prob, min=1e-10)
         # lc_psuedo = (c_prob * (c_prob.log() - c_prior.log())).mean()
         lc_psuedo = F.kl_div(c_prob.log(), c_prior)
@@ -212,24 +218,44 @@ class SQVAE(LightningModule):
         mse_kps = self.mse_x(kps, recon_kps)
         mse_bbox = self.mse_x(bbox, recon_bbox)
 
+        # copy the whole batch off the device in one round trip
+        tensors = dict(
+            ids=ids,
+            kps=kps,
+            recon_kps=recon_kps,
+            mse_kps=mse_kps,
+            bbox=bbox,
+            recon_bbox=recon_bbox,
+            mse_bbox=mse_bbox,
+            ze=ze,
+            zq=zq,
+            attn_w=attn_w,
+            prob=prob,
+            c_prob=c_prob,
+        )
+        tensors = {k: v.to("cpu", non_blocking=True) for k, v in tensors.items()}
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        arrays = {k: v.numpy() for k, v in tensors.items()}
+
         results = []
         for i in range(len(keys)):
             data = {
                 "key": keys[i],
-                "id": ids[i].cpu().numpy().item(),
-                "kps": kps[i].cpu().numpy(),
-                "recon_kps": recon_kps[i].cpu().numpy(),
-                "mse_kps": mse_kps[i].item(),
-                "bbox": bbox[i].cpu().numpy(),
-                "recon_bbox": recon_bbox[i].cpu().numpy(),
-                "mse_bbox": mse_bbox[i].item(),
-                "ze": ze[i].cpu().numpy(),
-                "zq": zq[i].cpu().numpy(),
-                "attn_w": attn_w[i].cpu().numpy(),
-                "book_prob": prob[i].cpu().numpy(),
-                "book_idx": prob[i].cpu().numpy().argmax(axis=1),
-                "label_prob": c_prob[i].cpu().numpy(),
-                "label": c_prob[i].cpu().numpy().argmax(),
+                "id": arrays["ids"][i].item(),
+                "kps": arrays["kps"][i],
+                "recon_kps": arrays["recon_kps"][i],
+                "mse_kps": arrays["mse_kps"][i].item(),
+                "bbox": arrays["bbox"][i],
+                "recon_bbox": arrays["recon_bbox"][i],
+                "mse_bbox": arrays["mse_bbox"][i].item(),
+                "ze": arrays["ze"][i],
+                "zq": arrays["zq"][i],
+                "attn_w": arrays["attn_w"][i],
+                "book_prob": arrays["prob"][i],
+                "book_idx": arrays["prob"][i].argmax(axis=1),
+                "label_prob": arrays["c_prob"][i],
+                "label": arrays["c_prob"][i].argmax(),
             }
             results.append(data)
 
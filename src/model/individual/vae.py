@@ -6,10 +6,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from lightning.pytorch import LightningModule
-from rotary_embedding_torch import RotaryEmbedding
+from torch.utils.checkpoint import checkpoint
 
 from src.model.layers import (
     MLP,
+    CachedRotaryEmbedding,
     Embedding,
     TransformerDecoderBlock,
     TransformerEncoderBlock,
@@ -53,12 +54,19 @@ class VAE(LightningModule):
     def configure_model(self):
         if self.Qy_x is not None:
             return
-        self.Qy_x = Qy_x(self.config)
-        self.Qz_xy = Qz_xy(self.config)
+        # shapes are static per config, so compile the core forward graphs
+        compile_kwargs = dict(mode="reduce-overhead", fullgraph=True, dynamic=False)
+        self.Qy_x = torch.compile(Qy_x(self.config), **compile_kwargs)
+        self.Qz_xy = torch.compile(Qz_xy(self.config), **compile_kwargs)
         # vis_npatchs = self.Qy_x.emb.emb.npatchs
         self.Py = Py(self.config)
-        self.Pz_y = Pz_y(self.config)
-        self.Px_z = nn.ModuleList([Px_z(self.config) for _ in range((17 + 2) * 2)])
+        self.Pz_y = torch.compile(Pz_y(self.config), **compile_kwargs)
+        self.Px_z = nn.ModuleList(
+            [
+                torch.compile(Px_z(self.config), **compile_kwargs)
+                for _ in range((17 + 2) * 2)
+            ]
+        )
 
         if self.annotation_path is not None:
             anns = np.loadtxt(self.annotation_path, int, delimiter=" ", skiprows=1)
@@ -66,14 +74,21 @@ class VAE(LightningModule):
 
     def loss_x(self, x, recon_x, mask=None):
         b = x.size(0)
-        mses = torch.empty((0,)).to(self.device)
-        for i in range(b):
-            # mse = F.mse_loss(recon_x[i][~mask[i]], x[i][~mask[i]])
-            mse = F.mse_loss(recon_x[i], x[i])
-            mses = torch.cat([mses, mse.view(1, 1)])
-        return mses.ravel()  # (b,)
+        diff = (recon_x - x) ** 2
+        if mask is None:
+            return diff.reshape(b, -1).mean(dim=1)  # (b,)
+
+        # masked mean without data-dependent boolean gathers; the mask may
+        # still live on the CPU when predict_step is called directly
+        m = (~mask.to(diff.device)).reshape(b, -1, 1).to(diff.dtype)
+        diff = diff.reshape(b, m.size(1), -1)
+        n_valid = (m.sum(dim=1) * diff.size(2)).clamp(min=1).squeeze(1)
+        return (diff * m).sum(dim=(1, 2)) / n_valid  # (b,)
 
     def loss_kl(self, q, p, weights=None, eps=1e-10):
+        # compute in fp32 to avoid log underflow under bf16 autocast
+        q = q.float()
+        p = p.float()
         kl = (q * (torch.log(q + eps) - torch.log(p + eps))).sum(dim=-1)
         if weights is None:
             kl = kl.mean()
@@ -83,12 +98,10 @@ class VAE(LightningModule):
 
     def loss_kl_gaussian(self, mu1, logv1, mu2, logv2, weights=None):
         # mu, log (b, latent_ndim)
+        # share the exponentials instead of three separate .exp() calls
+        dlogv = logv1 - logv2
         lg = -0.5 * (
-            1
-            + logv1
-            - logv2
-            - logv1.exp() / logv2.exp()
-            - (mu1 - mu2) ** 2 / logv2.exp()
+            1 + dlogv - dlogv.exp() - (mu1 - mu2) ** 2 * (-logv2).exp()
         ).sum(dim=-1)
         if weights is None:
             lg = lg.mean()
@@ -116,16 +129,16 @@ class VAE(LightningModule):
 
         b, seq_len = x_kps.size()[:2]
         x_kps = x_kps.view(b, seq_len, 17 * 2)
-        recon_x_kps = torch.empty((b, seq_len, 0)).to(self.device)
+        recon_x_kps = []
         for i, decoder in enumerate(self.Px_z[: 17 * 2]):
-            recon_x = decoder(x_kps[:, :, i], z[:, i, :])
-            recon_x_kps = torch.cat([recon_x_kps, recon_x], dim=2)
+            recon_x_kps.append(decoder(x_kps[:, :, i], z[:, i, :]))
+        recon_x_kps = torch.cat(recon_x_kps, dim=2)
 
         x_bbox = x_bbox.view(b, seq_len, 2 * 2)
-        recon_x_bbox = torch.empty((b, seq_len, 0)).to(self.device)
+        recon_x_bbox = []
         for i, decoder in enumerate(self.Px_z[17 * 2 :]):
-            recon_x = decoder(x_bbox[:, :, i], z[:, i, :])
-            recon_x_bbox = torch.cat([recon_x_bbox, recon_x], dim=2)
+            recon_x_bbox.append(decoder(x_bbox[:, :, i], z[:, i, :]))
+        recon_x_bbox = torch.cat(recon_x_bbox, dim=2)
 
         x_kps = x_kps.view(b, seq_len, 17, 2)
         x_bbox = x_bbox.view(b, seq_len, 2, 2)
@@ -248,22 +261,18 @@ class VAE(LightningModule):
         #         self.logvar_all = torch.empty((0, self.latent_ndim)).cpu()
         #         self.ids_all = []
 
-        del z, mu, logvar, z_prior, mu_prior, logvar_prior
-        del keys, ids, x_kps, x_bbox, mask
-
     @staticmethod
     def log_normal(z, mu, logvar):
         return -0.5 * (logvar + (z - mu) ** 2 / logvar.exp())  # + np.log(2.0 * np.pi)
 
     def pairwise_sim(self, mu, logvar):
         b = mu.size(0)
-        pij = torch.empty((0, b, self.latent_ndim * 19 * 2), dtype=torch.float32).to(
-            self.device
-        )
+        pij = []
         for i in range(b):
             pdfs = self.log_normal(mu, mu[i], logvar[i]).exp()
             pdfs = pdfs / pdfs.sum(dim=0)
-            pij = torch.cat([pij, pdfs.view(1, b, self.latent_ndim * 19 * 2)], dim=0)
+            pij.append(pdfs.view(b, self.latent_ndim * 19 * 2))
+        pij = torch.stack(pij, dim=0)
 
         # diag to zero
         pij = pij * ((1 - torch.eye(b)) + 1e-30).view(b, b, 1).to(self.device)
@@ -302,8 +311,9 @@ class VAE(LightningModule):
     @torch.no_grad()
     def predict_step(self, batch):
         keys, ids, x_kps, x_bbox, mask = batch
-        x_kps = x_kps.to(next(self.parameters()).device)
-        x_bbox = x_bbox.to(next(self.parameters()).device)
+        # batches come out of the loader pinned, so the copy can be async
+        x_kps = x_kps.to(next(self.parameters()).device, non_blocking=True)
+        x_bbox = x_bbox.to(next(self.parameters()).device, non_blocking=True)
         # mask = mask.to(next(self.parameters()).device)
         if x_kps.ndim == 5:
             ids = ids[0]
@@ -317,16 +327,16 @@ class VAE(LightningModule):
 
         b, seq_len = x_kps.size()[:2]
         x_kps = x_kps.view(b, seq_len, 17 * 2)
-        recon_x_kps = torch.empty((b, seq_len, 0)).to(self.device)
+        recon_x_kps = []
         for i, decoder in enumerate(self.Px_z[: 17 * 2]):
-            recon_x = decoder(x_kps[:, :, i], z[:, i, :])
-            recon_x_kps = torch.cat([recon_x_kps, recon_x], dim=2)
+            recon_x_kps.append(decoder(x_kps[:, :, i], z[:, i, :]))
+        recon_x_kps = torch.cat(recon_x_kps, dim=2)
 
         x_bbox = x_bbox.view(b, seq_len, 2 * 2)
-        recon_x_bbox = torch.empty((b, seq_len, 0)).to(self.device)
+        recon_x_bbox = []
         for i, decoder in enumerate(self.Px_z[17 * 2 :]):
-            recon_x = decoder(x_bbox[:, :, i], z[:, i, :])
-            recon_x_bbox = torch.cat([recon_x_bbox, recon_x], dim=2)
+            recon_x_bbox.append(decoder(x_bbox[:, :, i], z[:, i, :]))
+        recon_x_bbox = torch.cat(recon_x_bbox, dim=2)
 
         mse_x_kps = self.loss_x(x_kps, recon_x_kps, mask)
         mse_x_bbox = self.loss_x(x_bbox, recon_x_bbox, mask)
@@ -336,27 +346,44 @@ class VAE(LightningModule):
         x_bbox = x_bbox.view(b, seq_len, 2, 2)
         recon_x_bbox = recon_x_bbox.view(b, seq_len, 2, 2)
 
+        # copy the whole batch off the device in one round trip
+        tensors = dict(
+            ids=ids,
+            x_kps=x_kps,
+            recon_x_kps=recon_x_kps,
+            mse_x_kps=mse_x_kps,
+            x_bbox=x_bbox,
+            recon_x_bbox=recon_x_bbox,
+            mse_x_bbox=mse_x_bbox,
+            z=z,
+            mu=mu,
+            logvar=logvar,
+            y=y,
+        )
+        tensors = {k: v.to("cpu", non_blocking=True) for k, v in tensors.items()}
+        if self.device.type == "cuda":
+            torch.cuda.synchronize()
+        arrays = {k: v.numpy() for k, v in tensors.items()}
+
         results = []
         for i in range(len(keys)):
             # label_prob = self.clustering_prob(z[i], mu[i], logvar[i], mask[i])
             data = {
                 "key": keys[i],
-                "id": ids[i].cpu().numpy().item(),
-                # "x_kps": x_kps[0].cpu().numpy().transpose(0, 2, 3, 1),
-                # "fake_x_kps": fake_x_kps[0].cpu().numpy().transpose(0, 2, 3, 1),
-                "x_kps": x_kps[i].cpu().numpy(),
-                "recon_x_kps": recon_x_kps[i].cpu().numpy(),
-                "mse_x_kps": mse_x_kps.item(),
-                "x_bbox": x_bbox[i].cpu().numpy(),
-                "recon_x_bbox": recon_x_bbox[i].cpu().numpy(),
-                "mse_x_bbox": mse_x_bbox.item(),
-                "z": z[i].cpu().numpy(),
-                "mu": mu[i].cpu().numpy(),
-                "logvar": logvar[i].cpu().numpy(),
+                "id": arrays["ids"][i].item(),
+                "x_kps": arrays["x_kps"][i],
+                "recon_x_kps": arrays["recon_x_kps"][i],
+                "mse_x_kps": arrays["mse_x_kps"][i].item(),
+                "x_bbox": arrays["x_bbox"][i],
+                "recon_x_bbox": arrays["recon_x_bbox"][i],
+                "mse_x_bbox": arrays["mse_x_bbox"][i].item(),
+                "z": arrays["z"][i],
+                "mu": arrays["mu"][i],
+                "logvar": arrays["logvar"][i],
                 # "label_prob": label_prob[i].cpu().numpy(),
                 # "label": label_prob[i].cpu().numpy().argmax().item(),
-                "label_prob": y[i].cpu().numpy(),
-                "label": y[i].cpu().numpy().argmax().item(),
+                "label_prob": arrays["y"][i],
+                "label": arrays["y"][i].argmax().item(),
                 # "mask": mask[i].cpu().numpy(),
             }
             results.append(data)
@@ -379,7 +406,7 @@ class Qy_x(nn.Module):
         self.emb_bbox = Embedding(
             config.seq_len, config.hidden_ndim, config.latent_ndim
         )
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         self.encoders = nn.ModuleList(
             [
                 TransformerEncoderBlock(
@@ -388,9 +415,7 @@ class Qy_x(nn.Module):
                 for _ in range(config.nlayers)
             ]
         )
-        self.mlp = nn.Sequential(
-            MLP(config.latent_ndim, config.n_clusters), nn.Softmax(dim=-1)
-        )
+        self.mlp = MLP(config.latent_ndim, config.n_clusters)
 
     def forward(self, x_kps, x_bbox, mask=None):
         # embedding
@@ -399,16 +424,20 @@ class Qy_x(nn.Module):
         # embedding
         x_kps = self.emb_kps(x_kps)  # (b, 17 * 2, latent_ndim)
         x_bbox = self.emb_bbox(x_bbox)  # (b, 2 * 2, latent_ndim)
-        z = torch.cat([self.cls.repeat(b, 1, 1), x_kps, x_bbox], dim=1)
+        z = torch.cat([self.cls.expand(b, -1, -1), x_kps, x_bbox], dim=1)
         # z (b, (17 + 2) * 2 + 1, latent_ndim)
 
         # positional embedding
         z = self.pe.rotate_queries_or_keys(z, seq_dim=1)
 
         for layer in self.encoders:
-            z, attn_w = layer(z, mask)
+            if self.training:
+                # recompute activations in backward to save memory
+                z, attn_w = checkpoint(layer, z, mask, use_reentrant=False)
+            else:
+                z, attn_w = layer(z, mask)
 
-        logits = self.mlp(z[:, 0, :])
+        logits = F.softmax(self.mlp(z[:, 0, :]), dim=-1)
         # (b, n_clusters)
         return logits
 
@@ -424,7 +453,7 @@ class Qz_xy(nn.Module):
             config.seq_len, config.hidden_ndim, config.latent_ndim
         )
         self.emb_y = MLP(config.n_clusters, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         self.encoders = nn.ModuleList(
             [
                 TransformerEncoderBlock(
@@ -434,8 +463,8 @@ class Qz_xy(nn.Module):
             ]
         )
 
-        self.lin_mu = nn.Linear(config.latent_ndim, config.latent_ndim)
-        self.lin_logvar = nn.Linear(config.latent_ndim, config.latent_ndim)
+        # single head producing mu and logvar, split with chunk
+        self.lin_muvar = nn.Linear(config.latent_ndim, config.latent_ndim * 2)
 
     def forward(self, x_kps, x_bbox, y, mask=None):
         # embedding
@@ -451,13 +480,16 @@ class Qz_xy(nn.Module):
         z = self.pe.rotate_queries_or_keys(z, seq_dim=1)
 
         for layer in self.encoders:
-            z, attn_w = layer(z, mask)
+            if self.training:
+                # recompute activations in backward to save memory
+                z, attn_w = checkpoint(layer, z, mask, use_reentrant=False)
+            else:
+                z, attn_w = layer(z, mask)
         # z (b, (17 + 2) * 2, latent_ndim)
 
-        mu = self.lin_mu(z)
-        logvar = self.lin_logvar(z)
-        ep = torch.randn_like(logvar)
-        z = mu + logvar.mul(0.5).exp() * ep
+        # keep the variance in fp32 under bf16 autocast
+        mu, logvar = self.lin_muvar(z).float().chunk(2, dim=-1)
+        z = torch.addcmul(mu, logvar.mul(0.5).exp(), torch.randn_like(logvar))
         # z, mu, log_sig (b, (17 + 2) * 2, latent_ndim)
 
         return z, mu, logvar
@@ -476,16 +508,17 @@ class Pz_y(nn.Module):
         self.seq_len = config.seq_len
         self.latent_ndim = config.latent_ndim
         self.mlp = MLP(config.n_clusters, config.latent_ndim * (17 + 2) * 2)
-        self.lin_mu = nn.Linear(config.latent_ndim, config.latent_ndim)
-        self.lin_logvar = nn.Linear(config.latent_ndim, config.latent_ndim)
+        # single head producing mu and logvar, split with chunk
+        self.lin_muvar = nn.Linear(config.latent_ndim, config.latent_ndim * 2)
 
     def forward(self, y):
         b = y.size(0)
         z = self.mlp(y).view(b, (17 + 2) * 2, self.latent_ndim)
-        mu_prior = self.lin_mu(z)
-        logvar_prior = self.lin_logvar(z)
-        ep = torch.randn_like(logvar_prior)
-        z_prior = mu_prior + logvar_prior.mul(0.5).exp() * ep
+        # keep the variance in fp32 under bf16 autocast
+        mu_prior, logvar_prior = self.lin_muvar(z).float().chunk(2, dim=-1)
+        z_prior = torch.addcmul(
+            mu_prior, logvar_prior.mul(0.5).exp(), torch.randn_like(logvar_prior)
+        )
 
         return z_prior, mu_prior, logvar_prior
 
@@ -501,7 +534,7 @@ class Px_z(nn.Module):
         )
 
         self.emb = MLP(1, config.latent_ndim)
-        self.pe = RotaryEmbedding(config.latent_ndim, learned_freq=True)
+        self.pe = CachedRotaryEmbedding(config.latent_ndim, learned_freq=True)
         self.mlp_z = MLP(config.latent_ndim, config.latent_ndim * config.seq_len)
         self.decoders = nn.ModuleList(
             [
@@ -511,12 +544,8 @@ class Px_z(nn.Module):
                 for _ in range(config.nlayers)
             ]
         )
-        self.mlp = nn.Sequential(
-            MLP(config.latent_ndim, config.hidden_ndim),
-            nn.SiLU(),
-            MLP(config.hidden_ndim, 1),
-            nn.Tanh(),
-        )
+        self.mlp1 = MLP(config.latent_ndim, config.hidden_ndim)
+        self.mlp2 = MLP(config.hidden_ndim, 1)
 
     def forward(self, x, z, mask=None):
         # x (b, seq_len)
@@ -527,7 +556,7 @@ class Px_z(nn.Module):
         x = self.emb(x)  # (b, seq_len, latent_ndim)
 
         # concat start token
-        x = torch.cat([self.x_start.repeat((b, 1, 1)), x], dim=1)
+        x = torch.cat([self.x_start.expand(b, -1, -1), x], dim=1)
         x = x[:, :-1]  # (b, seq_len, latent_ndim)
 
         x = self.pe.rotate_queries_or_keys(x, seq_dim=1)
@@ -535,9 +564,14 @@ class Px_z(nn.Module):
         z = self.mlp_z(z)
         z = z.view(b, seq_len, self.latent_ndim)
         for layer in self.decoders:
-            x = layer(x, z, mask)
+            if self.training:
+                # recompute activations in backward to save memory
+                x = checkpoint(layer, x, z, mask, use_reentrant=False)
+            else:
+                x = layer(x, z, mask)
         # x (b, seq_len, latent_ndim)
 
-        recon_x = self.mlp(x).view(b, seq_len, 1)
+        x = F.silu(self.mlp1(x))
+        recon_x = torch.tanh(self.mlp2(x)).view(b, seq_len, 1)
 
         return recon_x
@@ -1,2 +1,4 @@
+from .embedding import Embedding
 from .feedforward import MLP, SwiGLU
+from .rotary import CachedRotaryEmbedding
 from .transformer import TransformerDecoderBlock, TransformerEncoderBlock
@@ -0,0 +1,45 @@
+import torch.nn as nn
+
+from .feedforward import MLP
+
+
+class Embedding(nn.Module):
+    def __init__(self, seq_len: int, hidden_ndim: int, latent_ndim: int):
+        super().__init__()
+        self.hidden_ndim = hidden_ndim
+        # 1D convolutions over the sequence axis, one channel per point-coord
+        self.conv1 = nn.Sequential(
+            nn.Conv1d(1, hidden_ndim // 4, 10, 5),
+            nn.GroupNorm(1, hidden_ndim // 4),
+            nn.SiLU(),
+        )
+        self.conv2 = nn.Sequential(
+            nn.Conv1d(hidden_ndim // 4, hidden_ndim // 2, 5, 2),
+            nn.GroupNorm(1, hidden_ndim // 2),
+            nn.SiLU(),
+        )
+        self.conv3 = nn.Sequential(
+            nn.Conv1d(hidden_ndim // 2, hidden_ndim, 5, 2),
+            nn.GroupNorm(1, hidden_ndim),
+            nn.SiLU(),
+        )
+
+        out_len = seq_len
+        for kernel_size, stride in ((10, 5), (5, 2), (5, 2)):
+            out_len = (out_len - kernel_size) // stride + 1
+        self.mlp = MLP(hidden_ndim * out_len, latent_ndim)
+
+    def forward(self, x):
+        # x (b, seq_len, n_pts, 2)
+        b, seq_len = x.size()[:2]
+        x = x.view(b, seq_len, -1).permute(0, 2, 1)
+        npts = x.size(1)
+        x = x.reshape(b * npts, 1, seq_len)
+
+        x = self.conv1(x)
+        x = self.conv2(x)
+        x = self.conv3(x)  # (b * n_pts * 2, hidden_ndim, out_len)
+
+        x = x.view(b, npts, -1)
+        x = self.mlp(x)  # (b, n_pts * 2, latent_ndim)
+        return x
@@ -0,0 +1,27 @@
+from rotary_embedding_torch import RotaryEmbedding
+
+
+class CachedRotaryEmbedding(RotaryEmbedding):
+    """RotaryEmbedding whose frequency table is cached at eval time.
+
+    The frequencies are learned in this repo, so the library disables its own
+    cache and recomputes the table every forward. During eval they are frozen
+    and depend only on seq_len, so the table from the first call can be reused.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._eval_freqs = None
+        self._eval_freqs_key = None
+
+    def forward(self, t, seq_len=None, offset=0):
+        if self.training or seq_len is None:
+            self._eval_freqs = None
+            self._eval_freqs_key = None
+            return super().forward(t, seq_len=seq_len, offset=offset)
+
+        key = (seq_len, offset, t.device)
+        if self._eval_freqs_key != key:
+            self._eval_freqs = super().forward(t, seq_len=seq_len, offset=offset)
+            self._eval_freqs_key = key
+        return self._eval_freqs
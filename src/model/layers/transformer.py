@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 
 from .feedforward import SwiGLU
 
@@ -37,8 +39,14 @@ class TransformerEncoderBlock(nn.Module):
         return x, attn_w
 
     def attention_block(self, x, mask, need_weights):
-        x, attn_w = self.attn(x, x, x, attn_mask=mask, need_weights=need_weights)
-        return x, attn_w
+        if need_weights:
+            x, attn_w = self.attn(x, x, x, attn_mask=mask, need_weights=True)
+            return x, attn_w
+        dropout_p = self.attn.dropout if self.training else 0.0
+        x = scaled_dot_product_block(
+            self.attn, self.nheads, x, x, attn_mask=mask, dropout_p=dropout_p
+        )
+        return x, None
 
     def feed_forward_block(self, x):
         x = self.ff(x)
@@ -67,7 +75,11 @@ class TransformerDecoderBlock(nn.Module):
     def forward(self, x, z, mask=None):
         b, seq_len = x.size()[:2]
         # x (b * seq_len, npatch, ndim)
-        tgt_mask = create_tgt_mask(mask, b, seq_len, self.nheads, x.device)
+        if mask is not None:
+            tgt_mask = create_tgt_mask(mask, b, seq_len, self.nheads, x.device)
+        else:
+            # SDPA applies causality itself, no (seq_len, seq_len) mask needed
+            tgt_mask = None
         x = self.norm1(x)
         x = x + self.attention_block1(x, tgt_mask)
 
@@ -84,11 +96,23 @@ class TransformerDecoderBlock(nn.Module):
         return x
 
     def attention_block1(self, x, mask):
-        x = self.attn1(x, x, x, attn_mask=mask, need_weights=False)[0]
+        dropout_p = self.attn1.dropout if self.training else 0.0
+        x = scaled_dot_product_block(
+            self.attn1,
+            self.nheads,
+            x,
+            x,
+            attn_mask=mask,
+            is_causal=mask is None,
+            dropout_p=dropout_p,
+        )
         return x
 
     def attention_block2(self, x, z, mask):
-        x = self.attn2(x, z, z, attn_mask=mask, need_weights=False)[0]
+        dropout_p = self.attn2.dropout if self.training else 0.0
+        x = scaled_dot_product_block(
+            self.attn2, self.nheads, x, z, attn_mask=mask, dropout_p=dropout_p
+        )
         return x
 
     def feed_forward_block(self, x):
@@ -97,6 +121,38 @@ class TransformerDecoderBlock(nn.Module):
         return x
 
 
+def scaled_dot_product_block(
+    attn, nheads, q_in, kv_in, attn_mask=None, is_causal=False, dropout_p=0.0
+):
+    # project q/k/v with the nn.MultiheadAttention weights and run SDPA,
+    # which avoids materializing the (seq_len, seq_len) attention matrix
+    b, tgt_len, ndim = q_in.size()
+    src_len = kv_in.size(1)
+    w, bias = attn.in_proj_weight, attn.in_proj_bias
+    q = F.linear(q_in, w[:ndim], bias[:ndim] if bias is not None else None)
+    kv = F.linear(kv_in, w[ndim:], bias[ndim:] if bias is not None else None)
+    k, v = kv.chunk(2, dim=-1)
+
+    head_dim = ndim // nheads
+    q = q.view(b, tgt_len, nheads, head_dim).transpose(1, 2)
+    k = k.view(b, src_len, nheads, head_dim).transpose(1, 2)
+    v = v.view(b, src_len, nheads, head_dim).transpose(1, 2)
+
+    if attn_mask is not None:
+        # this repo's masks follow the MHA convention (True = masked out)
+        if attn_mask.dim() == 3:
+            attn_mask = attn_mask.view(b, nheads, tgt_len, src_len)
+        attn_mask = ~attn_mask
+
+    with sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+        x = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal
+        )
+    x = x.transpose(1, 2).reshape(b, tgt_len, ndim)
+    x = attn.out_proj(x)
+    return x
+
+
 def create_src_mask(mask, b, seq_len, nheads):
     mask = (
         mask.view(b, 1, seq_len)